@@ -7,10 +7,73 @@
 #   03/22/21: Created ButterflyNetwork class.
 
 import numpy as np
-from numpy.linalg import svd
+from functools import lru_cache
+from numba import njit
 from .mesh import StructuredMeshNetwork
 from .crossing import Crossing, MZICrossing
 
+
+def _butterfly_perms(N):
+    r"""
+    Permutation pairs (p1, p2) that route into / out of a layer of stride-s crossings, keyed by stride.  Only the
+    log2(N) distinct strides s = 1, 2, ..., N/2 occur, so each pair is built once (vectorized) and shared among all
+    layers with the same stride.
+    :param N: Mesh size.
+    :return: dict {s: (p1, p2)}
+    """
+    perms = {}
+    for s in 1 << np.arange(int(np.log2(N))):
+        block = np.arange(0, N, 2*s)[:, None]
+        x1 = (np.arange(s)[:, None] + np.array([[0, s]])).flatten()
+        x2 = (np.arange(0, 2*s, 2)[None, :] + np.array([[0], [1]])).flatten()
+        perms[s] = ((x1 + block).flatten(), (x2 + block).flatten())
+    return perms
+
+
+@lru_cache(maxsize=32)
+def _butterfly_topology(N):
+    r"""
+    Topology data for an N-point butterfly mesh: (lens, shifts, perm, strides, perms), with perms the stride-keyed
+    permutation table from _butterfly_perms.  This depends only on N, so it is memoized across instances (use cases
+    often construct many same-size meshes); the cached arrays are marked read-only since they are shared.
+    :param N: Mesh size (power of 2).
+    :return: (lens, shifts, perm, strides, perms)
+    """
+    lens = (N//2,)*(N-1); shifts = (0,)*(N-1)
+    k = np.arange(1, N); strides = k & -k   # strides[i] = largest power of 2 dividing i+1
+    perms = _butterfly_perms(N)
+    strides.setflags(write=False)
+    for (p1, p2) in perms.values():
+        p1.setflags(write=False); p2.setflags(write=False)
+    perm = [None]*N
+    for i in range(1, N-1, 2):
+        perm[i:i+2] = perms[strides[i]]
+    return (lens, shifts, perm, strides, perms)
+
+
+@njit
+def _config_layer(D, phi, p1, p2, p_cr, phi_new):
+    # Fused per-layer configuration step: permute the accumulated output phases onto this layer, absorb them into the
+    # crossing amplitudes, solve each crossing for (theta, phi), and extract the residual output phases -- one pass
+    # over the layer with no temporary arrays.  Inlines MZICrossing.Tsolve(., 'T1:') and column 1 of MZICrossing.T,
+    # specialized to ideal splitters (beta = 0).
+    n = len(p_cr)
+    alpha = np.empty(2*n)
+    for j in range(n):
+        (ea, eb) = (np.exp(1j*phi[p1[2*j]]), np.exp(1j*phi[p1[2*j+1]]))
+        (T11, T12, T21) = (D[0, 0, j]*ea, D[0, 1, j]*eb, D[1, 0, j]*ea)
+        S2 = min(max(1 / (1 + np.abs(T12)**2/(np.abs(T11)**2 + 1e-30)), 0.), 1.)
+        (C, S) = (np.sqrt(1 - S2), np.sqrt(S2))
+        theta = 2*np.arcsin(S)
+        phi_mzi = np.angle(1j*C) - np.angle(1j*S) + np.angle(T11) - np.angle(T12)
+        p_cr[j, 0] = theta; p_cr[j, 1] = phi_mzi
+        e = np.exp(1j*(theta/2 + phi_mzi))
+        alpha[2*j]   = np.angle(T11 * np.conj(1j*S*e))
+        alpha[2*j+1] = np.angle(T21 * np.conj(1j*C*e))
+    for k in range(2*n):
+        phi_new[k] = alpha[p2[k]]
+
+
 class ButterflyNetwork(StructuredMeshNetwork):
     def __init__(self,
                  N:          int=None,
@@ -20,7 +83,9 @@ class ButterflyNetwork(StructuredMeshNetwork):
                  phi_out:    np.ndarray=None,
                  M:          np.ndarray=None,
                  X:          Crossing=MZICrossing(),
-                 phi_pos:    str='out'):
+                 phi_pos:    str='out',
+                 use_gpu:    bool=False,
+                 dtype:      np.dtype=np.complex128):
         r"""
         Mesh based on the generalized FFT butterfly fractal.  This mesh has layers of nonlocal crossings (stride 2^k).
         As a result, the distribution of splitting angles is not tightly concentrated near the cross state as in the
@@ -33,48 +98,63 @@ class ButterflyNetwork(StructuredMeshNetwork):
         :param M: Target matrix.
         :param X: Crossing type.
         :param phi_pos: Position of phase screen.  Currently only 'out' is supported.
+        :param use_gpu: Perform the configuration SVDs on the GPU (requires CuPy).
+        :param dtype: Dtype for the configuration SVDs.  np.complex64 halves memory traffic at reduced accuracy.
         """
         assert (N is None) ^ (M is None)
         assert (phi_pos == 'out')   # TODO -- phi_pos='in'
-        N = (N if N else len(M))
+        N = int(N if N else len(M))
         assert N == 2**int(np.log2(N))  # Size must be a power of 2.
-        if (M is not None) and (M.dtype != np.complex): M = M.astype(np.complex)
+        if (M is not None): M = M.astype(dtype, copy=False)
 
-        # Set up the mesh parameters and permutations for crossings with stride s > 1.
-        lens = [N//2]*(N-1); shifts = [0]*(N-1); perm = [None]*N
-        for i in range(1, N-1, 2):
-            s = 2**np.binary_repr(i+1)[::-1].index('1')
-            perm[i:i+2] = [(np.outer(1, x) + np.outer(np.arange(0, N, 2*s), 1)).flatten() for x in
-                    [np.outer(np.arange(s),1)+np.array([[0,s]]), np.outer(1,np.arange(0,2*s,2))+np.array([[0],[1]])]]
+        # Mesh parameters and permutations for crossings with stride s > 1 (layer i has stride
+        # s = 2^[trailing zeros of i+1]).  These depend only on N and come from a shared memoized table.
+        (lens, shifts, perm, strides, perms) = _butterfly_topology(N)
 
-        super(ButterflyNetwork, self).__init__(N, lens, shifts, p_phase=p_phase, p_splitter=p_splitter,
-                                               p_crossing=p_crossing, phi_out=phi_out, perm=perm, X=X, phi_pos=phi_pos)
+        super(ButterflyNetwork, self).__init__(N, list(lens), list(shifts), p_phase=p_phase, p_splitter=p_splitter,
+                                               p_crossing=p_crossing, phi_out=phi_out, perm=list(perm), X=X,
+                                               phi_pos=phi_pos)
 
         # Configure to match target matrix, if provided.
         if (M is not None):
             assert isinstance(self.X, MZICrossing)  # TODO -- generalize.
 
-            # Perform the recursive block-wise SVD of U to get the crossing amplitudes Dij.
-            def configButterfly(U, Dij):
-                N = len(U)
-                if (N > 2):
-                    (U11, U12, U21, U22) = (U[:N//2, :N//2], U[:N//2, N//2:], U[N//2:, :N//2], U[N//2:, N//2:])
-                    (V1, D11, W1) = svd(U11); (V2, D22, W2) = svd(U22)
-                    Dij[0, 0, N//2-1, :] = D11; Dij[0, 1, N//2-1, :] = np.diag(V1.T.conj().dot(U12).dot(W2.T.conj()))
-                    Dij[1, 1, N//2-1, :] = D22; Dij[1, 0, N//2-1, :] = np.diag(V2.T.conj().dot(U21).dot(W1.T.conj()))
-                    configButterfly(W1, Dij[:, :, :N//2, :N//4]); configButterfly(W2, Dij[:, :, :N//2, N//4:])
-                    configButterfly(V1, Dij[:, :, N//2:, :N//4]); configButterfly(V2, Dij[:, :, N//2:, N//4:])
-                else:
-                    Dij[:, :, 0, 0] = U
-            Dij = np.zeros([2, 2, N-1, N//2], dtype=np.complex); configButterfly(M, Dij)
+            # Perform the block-wise SVD of M to get the crossing amplitudes Dij.  The butterfly fractal is descended
+            # level by level: all same-size blocks at a given level are stacked and factored with a single batched
+            # np.linalg.svd call (LAPACK broadcasts over the leading axis), rather than recursing block-by-block in
+            # Python.  Each block tracks its (layer, column) offset into Dij, so results are scattered with one
+            # advanced-indexing write per level.  With use_gpu, the stacked blocks live on the GPU and each level is
+            # a single batched cuSOLVER SVD (CuPy dispatches 3D inputs to the batched path); Dij comes back to the
+            # host in one transfer at the end.
+            if use_gpu:
+                import cupy as xp
+            else:
+                xp = np
+            Dij = xp.empty([2, 2, N-1, N//2], dtype=dtype)   # Every entry is written below: 2m per node sums to 2N(N-1).
+            blocks = xp.asarray(M)[None]; lo = np.array([0]); co = np.array([0]); m = N
+            while (m > 2):
+                (U11, U12) = (blocks[:, :m//2, :m//2], blocks[:, :m//2, m//2:])
+                (U21, U22) = (blocks[:, m//2:, :m//2], blocks[:, m//2:, m//2:])
+                (V1, D11, W1) = xp.linalg.svd(U11); (V2, D22, W2) = xp.linalg.svd(U22)
+                D12 = xp.einsum('bji,bjk,bik->bi', V1.conj(), U12, W2.conj())  # diag(V1+ U12 W2+)
+                D21 = xp.einsum('bji,bjk,bik->bi', V2.conj(), U21, W1.conj())  # diag(V2+ U21 W1+)
+                (li, ci) = ((lo + m//2 - 1)[:, None], co[:, None] + np.arange(m//2))
+                Dij[0, 0, li, ci] = D11; Dij[0, 1, li, ci] = D12
+                Dij[1, 1, li, ci] = D22; Dij[1, 0, li, ci] = D21
+                blocks = xp.concatenate([W1, W2, V1, V2])
+                lo = np.concatenate([lo, lo, lo + m//2, lo + m//2])
+                co = np.concatenate([co, co + m//4, co, co + m//4]); m //= 2
+            Dij[:, :, lo, co] = blocks.transpose(1, 2, 0)
+            if use_gpu:
+                Dij = Dij.get()
 
-            # Convert the crossing amplitudes Dij into phase shifts (theta, phi).
-            p_crossing = self.p_crossing.reshape([N-1, N//2, 2]); phi_out = self.phi_out
+            # Convert the crossing amplitudes Dij into phase shifts (theta, phi).  The running output phases
+            # ping-pong between two working buffers (no aliased in-place permutes, no per-layer copy back into the
+            # phase screen); self.phi_out is written once at the end.
+            p_crossing = self.p_crossing.reshape([N-1, N//2, 2])
+            (phi, phi_next) = (self.phi_out.copy(), np.empty(N))
             for i in range(N-1):
-                s = 2**np.binary_repr(i+1)[::-1].index('1')   # Permutation stride
-                (p1, p2) = [(np.outer(1, x) + np.outer(np.arange(0, N, 2*s), 1)).flatten() for x in
-                        [np.outer(np.arange(s),1)+np.array([[0,s]]), np.outer(1,np.arange(0,2*s,2))+np.array([[0],[1]])]]
-                phi_out[:] = phi_out[p1]
-                Dij[:, 0, i, :] *= np.exp(1j*phi_out[::2]); Dij[:, 1, i, :] *= np.exp(1j*phi_out[1::2])
-                p_crossing[i] = np.array(self.X.Tsolve((Dij[0, 0, i], Dij[0, 1, i]), 'T1:')[:1])[0].T
-                phi_out[:] = np.angle(Dij[:, :, i]/self.X.T(p_crossing[i]))[:, 0, :].T.flatten()[p2]
+                (p1, p2) = perms[strides[i]]   # Permutations for this layer's stride
+                _config_layer(Dij[:, :, i], phi, p1, p2, p_crossing[i], phi_next)
+                (phi, phi_next) = (phi_next, phi)
+            self.phi_out[:] = phi
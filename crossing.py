@@ -189,7 +189,8 @@ class Crossing:
             # Compute T0*D0 from old crossing, find T based on amplitude ratios, solve new phases D*T = T0*D0 based on:
             # D = diag(T0*D0*(T*)) (the latter should be a diagonal matrix)
             T0 = self.T(p_in, s_in); T0[:, 0] *= np.exp(1j*phi[::2]); T0[:, 1] *= np.exp(1j*phi[1::2])
-            p_out = np.array(out.Tsolve((T0[0, 0], T0[0, 1]), 'T1:', s_out.T)[0]).T
+            (theta, phi_out) = out.Tsolve((T0[0, 0], T0[0, 1]), 'T1:', s_out.T)[0]
+            p_out = np.stack([theta, phi_out], axis=-1)
             T = out.T(p_out, s_out)
             phi = np.array([np.angle(T0[i, 0]*T[i, 0].conj() + T0[i, 1]*T[i, 1].conj()) for i in [0, 1]]).T.flatten()
             return (p_out, phi)